@@ -1,15 +1,24 @@
-# solver.py  (requests + BeautifulSoup; no external LLM)
+# solver.py  (requests + selectolax/lxml; no external LLM)
 import time
 import logging
 import re
-import json
 import base64
-import os
+import itertools
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
+from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
-from bs4 import BeautifulSoup
+import lxml.html
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:  # optional fast path; lxml is always available
+    HTMLParser = None
 
 from utils import (
     parse_question_text,
@@ -19,13 +28,53 @@ from utils import (
     file_bytes_to_data_uri,
     df_to_chart_data_uri,
     safe_json_parse,
-    enforce_payload_limit,   # <-- FIX ADDED
+    enforce_payload_limit,
 )
 from llm_agent import ask_llm_for_action
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("solver")
 
+# ----------------- patterns -----------------
+
+_ATOB = re.compile(r"atob\(`([^`]+)`\)")
+# every submit-url shape in one alternation, so the page is walked once;
+# rel/var stay case-sensitive like the original separate patterns. Each
+# value sits in a lookahead, so a match consumes only its prefix and any
+# other pattern starting inside the value is still found by finditer.
+_SUBMIT_ANY = re.compile(
+    r"(?P<abs>https?://[^\s'\"<>]+/(?:submit|post|answer|api)[^\s'\"<>]*)"
+    r"|(?-i:(?P<q>['\"])(?=(?P<rel>/submit[^\s'\"<>]*)(?P=q)))"
+    r"|\"submit_url\"\s*:\s*(?=\"(?P<json>[^\"]+)\")"
+    r"|(?-i:var\s+submitUrl\s*=\s*(?=['\"](?P<var>[^'\"]+)['\"]))",
+    re.I,
+)
+_FILE_URL = re.compile(r"https?://[^\s'\"<>]+\.(csv|pdf|xlsx|xls|json|wav|mp3|m4a|ogg)", re.I)
+_AUDIO_URL = re.compile(r"https?://[^\s'\"<>]+\.(mp3|wav|m4a|ogg)", re.I)
+_SCRAPE_PATH = re.compile(r"scrape\s+([\/][^\s'\"<>]+)", re.I)
+_SECRET_CODE = re.compile(r"secret\s*code\s*[:\-]?\s*([A-Za-z0-9_-]+)", re.I)
+_NONBLANK_LINE = re.compile(r"^[^\S\r\n]*\S", re.M)
+
+# elements whose contents are not visible page text
+_NON_TEXT_TAGS = ["script", "style", "template"]
+
+# download caps, well above typical quiz file sizes
+_MAX_DOWNLOAD_BYTES = {"pdf": 4_000_000, "csv": 2_000_000, "xls": 2_000_000, "xlsx": 2_000_000}
+_DEFAULT_MAX_DOWNLOAD = 4_000_000
+
+
+def _make_session() -> requests.Session:
+    # one pooled keep-alive session per solver run (most hops hit the same host)
+    session = requests.Session()
+    # retry connection failures only: re-sending after a read timeout could
+    # stack several 30-45 s waits past the solver deadline
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                          max_retries=Retry(total=2, read=0, backoff_factor=0.3))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate"})
+    return session
+
 
 # ----------------- entrypoint -----------------
 
@@ -37,15 +86,21 @@ def solve_quiz_with_deadline(url: str, email: str, secret: str,
         logger.warning("Not enough time left to start solver.")
         return
 
+    pool = ThreadPoolExecutor(max_workers=2)
     try:
-        _solve_quiz_chain(url, email, secret, deadline)
+        with _make_session() as session:
+            _solve_quiz_chain(session, pool, url, email, secret, deadline)
     except Exception as e:
         logger.exception("Solver error: %s", e)
+    finally:
+        # don't block the solver thread on a straggling download
+        pool.shutdown(wait=False)
 
 
 # ----------------- main loop -----------------
 
-def _solve_quiz_chain(initial_url: str, email: str, secret: str, deadline: float):
+def _solve_quiz_chain(session: requests.Session, pool: ThreadPoolExecutor,
+                      initial_url: str, email: str, secret: str, deadline: float):
 
     def time_left():
         return max(0, int(deadline - time.time()))
@@ -64,25 +119,20 @@ def _solve_quiz_chain(initial_url: str, email: str, secret: str, deadline: float
 
         # Fetch page
         try:
-            resp = requests.get(current_url, timeout=45)
+            resp = session.get(current_url, timeout=45)
             resp.raise_for_status()
         except Exception as e:
             logger.error("Page load failed: %s", e)
             break
 
-        html = resp.text or ""
-        soup = BeautifulSoup(html, "lxml")
-
-        page_text = soup.get_text(separator="\n")
-        pre_text = "\n\n".join(tag.get_text("\n") for tag in soup.find_all("pre"))
-        script_text = "\n\n".join(tag.get_text() for tag in soup.find_all("script"))
+        html = response_text(resp)
+        page_text, pre_text, script_text = extract_page_parts(html)
 
         # extract atob base64 strings
         decoded_chunks = []
-        for m in re.finditer(r"atob\(`([^`]+)`\)", script_text):
+        for m in _ATOB.finditer(script_text):
             try:
-                chunk = base64.b64decode(m.group(1).replace("\n", "")).decode("utf-8", errors="ignore")
-                decoded_chunks.append(chunk)
+                decoded_chunks.append(_decode_atob(m.group(1).replace("\n", "")))
             except Exception:
                 pass
 
@@ -101,31 +151,18 @@ def _solve_quiz_chain(initial_url: str, email: str, secret: str, deadline: float
             break
         logger.info("Submit URL: %s", submit_url)
 
-        # 2) File URL
+        # 2) File URL + 3) Scrape page, fetched concurrently
         file_url = detect_file_url(page_text, pre_text)
-        file_bytes = None
-        file_ext = None
-        if file_url:
-            try:
-                r = requests.get(file_url, timeout=30)
-                if r.ok:
-                    file_bytes = r.content
-                    file_ext = file_url.rsplit(".", 1)[-1].lower()
-                    logger.info("Downloaded file: %s (%d bytes)", file_ext, len(file_bytes))
-            except Exception as e:
-                logger.error("File download error: %s", e)
-
-        # 3) Scrape page
         scrape_url = detect_scrape_url(page_text, current_url)
-        secret_code = None
-        if scrape_url:
-            secret_code = scrape_secondary_page(scrape_url)
+
+        fut_file = pool.submit(download_file, session, file_url) if file_url else None
+        fut_scrape = pool.submit(scrape_secondary_page, session, scrape_url) if scrape_url else None
 
         # 4) Audio detection (disabled STT)
         audio_url = detect_audio_url(page_text, pre_text)
         audio_transcript = None
 
-        # 5) Decide action
+        # 5) Decide action (CPU work overlaps the downloads above)
         question_spec = parse_question_text(page_text, pre_text)
 
         if question_spec.get("action") == "return_text":
@@ -133,6 +170,13 @@ def _solve_quiz_chain(initial_url: str, email: str, secret: str, deadline: float
             if llm_spec:
                 question_spec.update(llm_spec)
 
+        file_bytes, file_ext = _wait_result(fut_file, deadline, (None, None))
+        secret_code = _wait_result(fut_scrape, deadline, None)
+
+        if time_left() <= 3:
+            logger.warning("Deadline reached before submit, stopping.")
+            break
+
         # 6) Compute answer
         answer = None
 
@@ -156,7 +200,7 @@ def _solve_quiz_chain(initial_url: str, email: str, secret: str, deadline: float
                     answer = val if val is not None else file_bytes_to_data_uri(file_bytes, "pdf")
 
                 elif file_ext == "json":
-                    parsed = safe_json_parse(file_bytes.decode("utf-8", errors="ignore"))
+                    parsed = safe_json_parse(file_bytes)
                     answer = parsed if parsed else file_bytes.decode("utf-8", errors="ignore")[:1000]
 
                 else:
@@ -166,7 +210,7 @@ def _solve_quiz_chain(initial_url: str, email: str, secret: str, deadline: float
                 act = question_spec.get("action")
 
                 if act == "count":
-                    answer = len([ln for ln in page_text.splitlines() if ln.strip()])
+                    answer = sum(1 for _ in _NONBLANK_LINE.finditer(page_text))
 
                 elif act == "chart":
                     try:
@@ -184,13 +228,14 @@ def _solve_quiz_chain(initial_url: str, email: str, secret: str, deadline: float
 
         # 7) Submit
         payload = {"email": email, "secret": secret, "url": current_url, "answer": answer}
-        payload = enforce_payload_limit(payload)
 
         next_url = None
         try:
-            resp = requests.post(submit_url, json=payload, timeout=25)
+            body = enforce_payload_limit(payload)
+            resp = session.post(submit_url, data=body,
+                                headers={"Content-Type": "application/json"}, timeout=25)
             logger.info("Submit HTTP %s", resp.status_code)
-            logger.info("Submit text: %s", resp.text[:1000])
+            logger.info("Submit text: %s", response_text(resp)[:1000])
 
             if resp.ok:
                 try:
@@ -213,70 +258,189 @@ def _solve_quiz_chain(initial_url: str, email: str, secret: str, deadline: float
 
 # ----------------- helpers -----------------
 
-def detect_submit_url(page_text: str, pre_text: str, current_url: str) -> Optional[str]:
-    content = (pre_text or "") + "\n" + (page_text or "")
+def response_text(resp) -> str:
+    # decode with the declared charset (utf-8 if none) instead of resp.text,
+    # which runs charset detection over the whole body when none is declared
+    return (resp.content or b"").decode(resp.encoding or "utf-8", errors="replace")
 
-    # 1. Absolute URLs containing /submit
-    m = re.search(r"https?://[^\s'\"<>]+/submit[^\s'\"<>]*", content, flags=re.I)
-    if m:
-        return m.group(0)
 
-    # 2. Absolute URLs with patterns submit/post/answer
-    m = re.search(r"https?://[^\s'\"<>]+/(submit|post|answer|api)[^\s'\"<>]*", content, flags=re.I)
-    if m:
-        return m.group(0)
+def _visible_text(tree) -> str:
+    # blank script/style/template in place, as bs4's get_text() skips them;
+    # drop_tree() would glue the surrounding text nodes together
+    for el in list(tree.iter(*_NON_TEXT_TAGS)):
+        el.text = None
+        del el[:]
+    return "\n".join(tree.itertext())
 
-    # 3. Relative /submit
-    m = re.search(r"(['\"])(\/submit[^\s'\"<>]*)\1", content)
-    if m:
-        from urllib.parse import urljoin
-        return urljoin(current_url, m.group(2))
 
-    # 4. JSON-like hidden fields
-    m = re.search(r'"submit_url"\s*:\s*"([^"]+)"', content, flags=re.I)
-    if m:
-        from urllib.parse import urljoin
-        return urljoin(current_url, m.group(1))
+def extract_page_parts(html: str):
+    """Return (page_text, pre_text, script_text) for an HTML page."""
+    pres, scripts = [], []
 
-    # 5. URL inside JS variables
-    m = re.search(r"var\s+submitUrl\s*=\s*['\"]([^'\"]+)['\"]", content)
-    if m:
-        from urllib.parse import urljoin
-        return urljoin(current_url, m.group(1))
+    if HTMLParser is not None:
+        try:
+            tree = HTMLParser(html)
+            for n in tree.css("pre, script"):
+                if n.tag == "pre":
+                    pres.append(n.text(separator="\n"))
+                else:
+                    scripts.append(n.text())
+            # like bs4's get_text(), leave script/style/template out of the page text
+            tree.strip_tags(_NON_TEXT_TAGS)
+            root = tree.root
+            page_text = root.text(separator="\n") if root else ""
+            return page_text, "\n\n".join(pres), "\n\n".join(scripts)
+        except Exception as e:
+            logger.warning("selectolax parse failed, falling back to lxml: %s", e)
+            pres, scripts = [], []
+
+    try:
+        tree = lxml.html.fromstring(html)
+    except Exception as e:
+        logger.error("HTML parse failed: %s", e)
+        return "", "", ""
 
-    # 6. Fallback: ANY URL on same domain containing keyword "submit"
+    # one traversal for both tags instead of two find_all walks
+    for el in tree.iter("pre", "script"):
+        if el.tag == "pre":
+            pres.append("\n".join(el.itertext()))
+        else:
+            scripts.append("".join(el.itertext()))
+
+    page_text = _visible_text(tree)
+    return page_text, "\n\n".join(pres), "\n\n".join(scripts)
+
+
+def extract_text(html: str) -> str:
+    if HTMLParser is not None:
+        try:
+            tree = HTMLParser(html)
+            tree.strip_tags(_NON_TEXT_TAGS)
+            root = tree.root
+            return root.text(separator="\n") if root else ""
+        except Exception as e:
+            logger.warning("selectolax parse failed, falling back to lxml: %s", e)
+
+    try:
+        return _visible_text(lxml.html.fromstring(html))
+    except Exception as e:
+        logger.error("HTML parse failed: %s", e)
+        return ""
+
+
+@lru_cache(maxsize=64)
+def _decode_atob(b64: str) -> str:
+    # quiz pages often embed the same blobs, so decode each one once
+    return base64.b64decode(b64).decode("utf-8", errors="ignore")
+
+
+def _search_both(pat, a, b):
+    # scan both buffers in place rather than concatenating them
+    return pat.search(a or "") or pat.search(b or "")
+
+
+def _submit_rank(m) -> int:
+    # lower is better: abs /submit, abs other, relative, json field, js var
+    kind = m.lastgroup
+    if kind == "abs":
+        return 0 if "/submit" in m.group("abs").lower() else 1
+    return {"rel": 2, "json": 3, "var": 4}[kind]
+
+
+def detect_submit_url(page_text: str, pre_text: str, current_url: str) -> Optional[str]:
+    """Find the submit URL, preferring absolute > relative /submit > json > var.
+
+    >>> detect_submit_url('"submit_url": "/submit"', '"submit_url": "/s/x"', "https://a.com/q")
+    'https://a.com/submit'
+    >>> detect_submit_url('var submitUrl = "/submit"', "var submitUrl = '/other'", "https://a.com/q")
+    'https://a.com/submit'
+    >>> detect_submit_url('"submit_url": "https://b.org/submit"', '"/submit/2"', "https://a.com/q")
+    'https://b.org/submit'
+    """
+    pre_text, page_text = pre_text or "", page_text or ""
+
+    best, best_rank = None, None
+    for m in itertools.chain(_SUBMIT_ANY.finditer(pre_text), _SUBMIT_ANY.finditer(page_text)):
+        rank = _submit_rank(m)
+        if best_rank is None or rank < best_rank:
+            best, best_rank = m, rank
+            if rank == 0:
+                break
+
+    if best is not None:
+        value = best.group(best.lastgroup)
+        if best.lastgroup == "abs":
+            return value
+        return urljoin(current_url, value)
+
+    # Fallback: ANY URL on same domain containing keyword "submit"
     domain = current_url.split("/")[2]
-    m = re.findall(r"https?://" + re.escape(domain) + r"[^\s'\"<>]+", content)
-    for url in m:
-        if "submit" in url.lower():
-            return url
+    same_domain = re.compile(r"https?://" + re.escape(domain) + r"[^\s'\"<>]+")
+    for m in itertools.chain(same_domain.finditer(pre_text), same_domain.finditer(page_text)):
+        if "submit" in m.group(0).lower():
+            return m.group(0)
 
     return None
 
 
-
 def detect_file_url(page_text, pre_text):
-    content = (pre_text or "") + "\n" + (page_text or "")
-    m = re.search(r"https?://[^\s'\"<>]+\.(csv|pdf|xlsx|xls|json|wav|mp3|m4a|ogg)", content, flags=re.I)
+    m = _search_both(_FILE_URL, pre_text, page_text)
     return m.group(0) if m else None
 
 
 def detect_scrape_url(page_text, current_url):
-    m = re.search(r"scrape\s+([\/][^\s'\"<>]+)", page_text, flags=re.I)
+    m = _SCRAPE_PATH.search(page_text)
     if m:
-        from urllib.parse import urljoin
         return urljoin(current_url, m.group(1))
     return None
 
 
-def scrape_secondary_page(url):
+def download_file(session, file_url):
+    """Return (bytes, ext) for file_url, or (None, None) on failure."""
+    file_ext = file_url.rsplit(".", 1)[-1].lower()
+    limit = _MAX_DOWNLOAD_BYTES.get(file_ext, _DEFAULT_MAX_DOWNLOAD)
+    try:
+        with session.get(file_url, stream=True, timeout=30) as r:
+            if not r.ok:
+                return None, None
+            # a partial file would give a silently wrong answer, so an
+            # oversized download is treated as no download at all
+            if int(r.headers.get("Content-Length") or 0) > limit:
+                logger.warning("File exceeds %d bytes, skipping download", limit)
+                return None, None
+            buf = bytearray()
+            for chunk in r.iter_content(65536):
+                if len(buf) + len(chunk) > limit:
+                    logger.warning("File exceeds %d bytes, skipping download", limit)
+                    return None, None
+                buf.extend(chunk)
+        file_bytes = bytes(buf)
+        logger.info("Downloaded file: %s (%d bytes)", file_ext, len(file_bytes))
+        return file_bytes, file_ext
+    except Exception as e:
+        logger.error("File download error: %s", e)
+    return None, None
+
+
+def _wait_result(future, deadline: float, default):
+    # wait for a background fetch, but never past the solver deadline
+    if future is None:
+        return default
+    try:
+        return future.result(timeout=max(0.0, deadline - time.time() - 3))
+    except Exception as e:
+        logger.error("Background fetch not ready: %s", e)
+        future.cancel()
+        return default
+
+
+def scrape_secondary_page(session, url):
     try:
-        r = requests.get(url, timeout=30)
+        r = session.get(url, timeout=30)
         r.raise_for_status()
-        soup = BeautifulSoup(r.text, "lxml")
-        text = soup.get_text("\n")
+        text = extract_text(response_text(r))
 
-        m = re.search(r"secret\s*code\s*[:\-]?\s*([A-Za-z0-9_-]+)", text, flags=re.I)
+        m = _SECRET_CODE.search(text)
         return m.group(1) if m else text.strip()[:300]
 
     except Exception as e:
@@ -285,6 +449,5 @@ def scrape_secondary_page(url):
 
 
 def detect_audio_url(page_text, pre_text):
-    content = (pre_text or "") + "\n" + (page_text or "")
-    m = re.search(r"https?://[^\s'\"<>]+\.(mp3|wav|m4a|ogg)", content, flags=re.I)
+    m = _search_both(_AUDIO_URL, pre_text, page_text)
     return m.group(0) if m else None
@@ -3,34 +3,54 @@ import re
 import io
 import base64
 import json
+import orjson
 import logging
+from functools import lru_cache
 
 # IMPORTANT: Use Agg backend so matplotlib works on Render (no display)
 import matplotlib
 matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
+import numpy as np
 import pandas as pd
 from typing import Any, Optional
 
 logger = logging.getLogger("utils")
 
+_CUTOFF_RE = re.compile(r"cutoff[:\s]+([0-9]+)")
+_SUM_COL_RE = re.compile(r"sum of the\s+['\"]?([a-z0-9 _-]+)['\"]?\s+column")
+_MAX_COL_RE = re.compile(r"(?:max(?:imum)? of the|maximum of the)\s+['\"]?([a-z0-9 _-]+)['\"]?\s+column")
+_MEAN_COL_RE = re.compile(r"(?:mean|average) of the\s+['\"]?([a-z0-9 _-]+)['\"]?\s+column")
+_PAGE_RE = re.compile(r"page\s+([0-9]+)")
+_NUM_RE = re.compile(r"[-+]?\d*\.\d+|\d+")
+_LONG_DIGITS = re.compile(r"\d{19}")
+_LONG_DIGITS_B = re.compile(rb"\d{19}")
+
 
 def text_lower(s):
     return s.lower() if s else s
 
 
 def parse_question_text(page_text: str, pre_text: Optional[str] = None) -> dict:
+    # callers update the spec in place, so hand out a copy of the cached dict
+    return dict(_parse_question_text_cached(page_text or "", pre_text or ""))
+
+
+@lru_cache(maxsize=256)
+def _parse_question_text_cached(page_text: str, pre_text: str) -> dict:
     text = (pre_text or "") + "\n" + (page_text or "")
     txt = text.lower()
 
     # detect cutoff patterns (e.g., "Cutoff: 38636")
-    m_cut = re.search(r"cutoff[:\s]+([0-9]+)", txt)
+    # cheap substring checks gate each regex; most pages match none of them
+    m_cut = _CUTOFF_RE.search(txt) if "cutoff" in txt else None
     cutoff = int(m_cut.group(1)) if m_cut else None
 
     # sum of column
     if "sum of the" in txt and "column" in txt:
-        m = re.search(r"sum of the\s+['\"]?([a-z0-9 _-]+)['\"]?\s+column", txt)
+        m = _SUM_COL_RE.search(txt)
         col = m.group(1) if m else None
         return {"action": "sum", "column": col, "cutoff": cutoff}
 
@@ -40,18 +60,18 @@ def parse_question_text(page_text: str, pre_text: Optional[str] = None) -> dict:
 
     # max/min
     if ("max" in txt or "maximum" in txt) and "column" in txt:
-        m = re.search(r"(?:max(?:imum)? of the|maximum of the)\s+['\"]?([a-z0-9 _-]+)['\"]?\s+column", txt)
+        m = _MAX_COL_RE.search(txt) if " of the" in txt else None
         col = m.group(1) if m else None
         return {"action": "max", "column": col, "cutoff": cutoff}
 
     if "mean" in txt or "average" in txt:
-        m = re.search(r"(?:mean|average) of the\s+['\"]?([a-z0-9 _-]+)['\"]?\s+column", txt)
+        m = _MEAN_COL_RE.search(txt) if "column" in txt else None
         col = m.group(1) if m else None
         return {"action": "mean", "column": col, "cutoff": cutoff}
 
     # pdf page mention
     if "page" in txt and "pdf" in txt:
-        m = re.search(r"page\s+([0-9]+)", txt)
+        m = _PAGE_RE.search(txt)
         page = int(m.group(1)) if m else None
         return {"action": "pdf_read", "page": page}
 
@@ -64,11 +84,31 @@ def parse_question_text(page_text: str, pre_text: Optional[str] = None) -> dict:
     return {"action": "return_text"}
 
 
+def _sniff_csv_column(bytes_data: bytes, col: Optional[str]) -> Optional[str]:
+    """Return the header name matching col (case-insensitive), if any."""
+    if not col:
+        return None
+    header = bytes_data.split(b"\n", 1)[0].decode("utf-8-sig", errors="ignore").strip()
+    for name in header.split(","):
+        name = name.strip().strip('"')
+        if name.lower() == col.lower():
+            return name
+    return None
+
+
 def compute_answer_from_csv_bytes(bytes_data: bytes, action: dict) -> Any:
+    # only parse the asked-for column when the header has it
+    resolved = _sniff_csv_column(bytes_data, action.get("column"))
+    usecols = [resolved] if resolved else None
+
     try:
-        df = pd.read_csv(io.BytesIO(bytes_data))
+        # pyarrow parses multithreaded; optional, so fall through if missing
+        df = pd.read_csv(io.BytesIO(bytes_data), engine="pyarrow", usecols=usecols)
     except Exception:
-        df = pd.read_csv(io.BytesIO(bytes_data), sep=None, engine="python")
+        try:
+            df = pd.read_csv(io.BytesIO(bytes_data), usecols=usecols)
+        except Exception:
+            df = pd.read_csv(io.BytesIO(bytes_data), sep=None, engine="python")
 
     return compute_answer_from_df(df, action)
 
@@ -78,24 +118,34 @@ def compute_answer_from_excel_bytes(bytes_data: bytes, action: dict) -> Any:
     return compute_answer_from_df(df, action)
 
 
+def _numeric_array(series: pd.Series) -> np.ndarray:
+    return pd.to_numeric(series, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+
+def _masked_values(arr: np.ndarray, cutoff) -> np.ndarray:
+    # drop NaNs and apply the cutoff in one vectorized mask
+    mask = ~np.isnan(arr)
+    if cutoff is not None:
+        mask &= arr > cutoff
+    return arr[mask]
+
+
 def compute_answer_from_df(df: pd.DataFrame, action: dict) -> Any:
     act = action.get("action")
     col = action.get("column")
     cutoff = action.get("cutoff")
 
-    # normalize column names
-    cols = [c.lower() for c in df.columns]
+    # normalize column names once; first column wins on case-insensitive clashes
+    lc2orig = {}
+    for c in df.columns:
+        lc2orig.setdefault(str(c).lower(), c)
 
     if col:
-        matches = [c for c in df.columns if c.lower() == col.lower()]
-        if matches:
-            colname = matches[0]
-        else:
-            candidate_cols = ["value", "amount", "price", "score", "count"]
-            colname = None
-            for cand in candidate_cols:
-                if cand in cols:
-                    colname = df.columns[cols.index(cand)]
+        colname = lc2orig.get(col.lower())
+        if colname is None:
+            for cand in ("value", "amount", "price", "score", "count"):
+                colname = lc2orig.get(cand)
+                if colname is not None:
                     break
     else:
         num_cols = [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])]
@@ -104,43 +154,41 @@ def compute_answer_from_df(df: pd.DataFrame, action: dict) -> Any:
     # count
     if act == "count":
         if cutoff is not None and colname:
-            return int((pd.to_numeric(df[colname], errors="coerce") > cutoff).sum())
+            arr = _numeric_array(df[colname])
+            return int(np.count_nonzero(arr > cutoff))
         return int(len(df))
 
     # numeric ops
     if colname:
-        series = pd.to_numeric(df[colname], errors="coerce").dropna()
-        if cutoff is not None:
-            series = series[series > cutoff]
+        vals = _masked_values(_numeric_array(df[colname]), cutoff)
 
         if act == "sum":
-            return float(series.sum())
+            return float(vals.sum())
         if act in ("mean", "average"):
-            return float(series.mean())
+            return float(vals.mean()) if vals.size else float("nan")
         if act == "max":
-            return float(series.max())
+            return float(vals.max()) if vals.size else float("nan")
         if act == "min":
-            return float(series.min())
+            return float(vals.min()) if vals.size else float("nan")
 
     # fallback: try common numeric columns
-    for candidate in ["value", "amount", "price", "score"]:
-        if candidate in cols:
-            s = pd.to_numeric(df[candidate], errors="coerce").dropna()
-            if cutoff is not None:
-                s = s[s > cutoff]
+    for candidate in ("value", "amount", "price", "score"):
+        if candidate in lc2orig:
+            vals = _masked_values(_numeric_array(df[lc2orig[candidate]]), cutoff)
             if act == "sum":
-                return float(s.sum())
+                return float(vals.sum())
 
     return int(len(df))
 
 
 def compute_answer_from_pdf_bytes(bytes_data: bytes, action: dict) -> Any:
-    import pdfplumber
     try:
-        with pdfplumber.open(io.BytesIO(bytes_data)) as pdf:
-            page_num = action.get("page")
+        page_num = action.get("page")
 
-            if page_num:
+        if page_num:
+            # pdfplumber only for the targeted page, which may hold a table
+            import pdfplumber
+            with pdfplumber.open(io.BytesIO(bytes_data)) as pdf:
                 idx = max(0, page_num - 1)
                 if idx < len(pdf.pages):
                     page = pdf.pages[idx]
@@ -154,18 +202,24 @@ def compute_answer_from_pdf_bytes(bytes_data: bytes, action: dict) -> Any:
                             return compute_answer_from_df(df, action)
 
                     if action.get("action") == "sum":
-                        nums = [float(x) for x in re.findall(r"[-+]?\d*\.\d+|\d+", text)]
+                        nums = [float(x) for x in _NUM_RE.findall(text)]
                         return float(sum(nums))
 
                     return text.strip()
 
-            # process entire PDF
-            full_text = "\n".join((p.extract_text() or "") for p in pdf.pages)
-            if action.get("action") == "sum":
-                nums = [float(x) for x in re.findall(r"[-+]?\d*\.\d+|\d+", full_text)]
-                return float(sum(nums))
-
-            return full_text.strip()
+        if action.get("action") == "sum":
+            # sum mode only needs the numbers, so stream pages through the
+            # lighter pypdf reader instead of joining the whole document
+            from pypdf import PdfReader
+            total = 0.0
+            for p in PdfReader(io.BytesIO(bytes_data)).pages:
+                total += sum(float(x) for x in _NUM_RE.findall(p.extract_text() or ""))
+            return float(total)
+
+        # the text itself is the answer here, so keep pdfplumber's extraction
+        import pdfplumber
+        with pdfplumber.open(io.BytesIO(bytes_data)) as pdf:
+            return "\n".join((p.extract_text() or "") for p in pdf.pages).strip()
 
     except Exception as e:
         logger.exception("PDF parse error: %s", e)
@@ -186,37 +240,61 @@ def file_bytes_to_data_uri(bytes_data: bytes, ext: str) -> str:
 
 
 def df_to_chart_data_uri(df, x=None, y=None, kind="bar") -> str:
+    # standalone Figure + Agg canvas: skips pyplot's global figure registry,
+    # which is not thread-safe across concurrent solver threads
     buf = io.BytesIO()
-    plt.figure(figsize=(6, 4))
+    fig = Figure(figsize=(6, 4))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.subplots()
 
     if x and y and x in df.columns and y in df.columns:
-        df.plot(kind=kind, x=x, y=y)
+        df.plot(kind=kind, x=x, y=y, ax=ax)
     else:
-        df.plot(kind=kind)
+        df.plot(kind=kind, ax=ax)
 
-    plt.tight_layout()
-    plt.savefig(buf, format="png")
-    plt.close()
+    fig.tight_layout()
+    canvas.print_png(buf)
 
     buf.seek(0)
     b64 = base64.b64encode(buf.read()).decode("ascii")
     return f"data:image/png;base64,{b64}"
 
 
-def safe_json_parse(s: str):
+def safe_json_parse(s):
+    """Parse JSON from str or bytes; returns None if it is not valid JSON."""
+    # orjson turns integers outside 64 bits (19+ digits) into floats without
+    # raising, so leave those documents to stdlib json
+    long_digits = _LONG_DIGITS_B if isinstance(s, bytes) else _LONG_DIGITS
+    if not long_digits.search(s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass  # NaN/Infinity or non-UTF-8 bytes; stdlib json is more lenient
+
     try:
-        return json.loads(s)
+        return json.loads(s.decode("utf-8", errors="ignore") if isinstance(s, bytes) else s)
     except Exception:
         return None
 
 
-def enforce_payload_limit(payload: dict) -> dict:
-    """Ensures final payload stays under 1MB."""
+def _dumps_payload(payload: dict) -> bytes:
     try:
-        data = json.dumps(payload).encode("utf-8")
-        if len(data) > 900_000:
-            if isinstance(payload.get("answer"), str):
-                payload["answer"] = payload["answer"][:200000]
-    except Exception:
-        pass
-    return payload
+        return orjson.dumps(payload, default=str,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError as e:
+        # orjson rejects ints beyond 64 bits and lone surrogates; stdlib json takes both
+        logger.warning("orjson could not encode payload, using json: %s", e)
+        return json.dumps(payload, default=str).encode("utf-8")
+
+
+def enforce_payload_limit(payload: dict) -> bytes:
+    """Serializes payload to JSON bytes, keeping it under 1MB.
+
+    The returned body is posted as-is, so the payload is only encoded once
+    (twice when the answer has to be truncated).
+    """
+    data = _dumps_payload(payload)
+    if len(data) > 900_000 and isinstance(payload.get("answer"), str):
+        payload["answer"] = payload["answer"][:200000]
+        data = _dumps_payload(payload)
+    return data